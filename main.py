@@ -1,17 +1,23 @@
 import html
-import re
+import os
+import asyncio
+import logging
 import importlib
-from typing import Dict
-from aiogram import Bot, Dispatcher, F
+from functools import lru_cache
+from typing import Dict, Optional
+from aiogram import Bot, Dispatcher, Router, F
 from aiogram.filters import Command
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.enums import ParseMode
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 import config
+import runtime_settings
 from vk_worker import VKWorker
 
 from aiogram.client.default import DefaultBotProperties
 
+logger = logging.getLogger(__name__)
+
 bot = Bot(
     token=config.TELEGRAM_TOKEN,
     default=DefaultBotProperties(parse_mode=ParseMode.HTML)
@@ -19,31 +25,63 @@ bot = Bot(
 dp = Dispatcher()
 worker = VKWorker()
 
-# Хранилище состояния: chat_id -> {"message_id": int, "last_text": str, "last_reply_markup": InlineKeyboardMarkup, "busy": bool, "last_state": dict, "use_auto_delay": bool}
+def _is_admin_chat(chat_id) -> bool:
+    """Пускает только ADMIN_CHAT_ID (если он задан); значение читается заново на каждом апдейте,
+    поэтому смена ADMIN_CHAT_ID в config.py подхватывается после reload_config без перезапуска."""
+    return not config.ADMIN_CHAT_ID or chat_id == config.ADMIN_CHAT_ID
+
+# Все команды и кнопки регистрируются на admin_router: проверка ADMIN_CHAT_ID выполняется
+# один раз фильтром роутера, а не в каждом хендлере. Остальным чатам отвечает guest_router.
+admin_router = Router()
+guest_router = Router()
+admin_router.message.filter(lambda message: _is_admin_chat(message.chat.id))
+admin_router.callback_query.filter(lambda query: query.message is not None and _is_admin_chat(query.message.chat.id))
+
+# Хранилище состояния: chat_id -> {"message_id": int, "last_text": str, "last_reply_markup": InlineKeyboardMarkup, "busy": bool, "last_state": dict, "use_auto_delay": bool,
+#                                   "pending_text": str, "last_edit_ts": float, "flush_task": asyncio.Task, "render_key": tuple, "cooldown_until": float,
+#                                   "edit_lock": asyncio.Lock}
 log_status: Dict[int, Dict] = {}
-current_top_count = config.TOP_COUNT
-current_processing_delay = config.PROCESSING_DELAY
-current_use_group = getattr(config, 'USE_GROUP', False)
+EDIT_MIN_INTERVAL = 1.0  # сек, минимальный интервал между правками лога (лимит Telegram ~1 правка/с на чат)
+runtime = runtime_settings.load()
 
 def reload_config():
-    """Перезагружает модуль config.py и возвращает обновленные значения."""
-    global current_top_count, current_processing_delay, current_use_group
+    """Перезагружает модуль config.py и заново применяет сохранённые настройки."""
+    global runtime
     importlib.reload(config)
-    current_top_count = config.TOP_COUNT
-    current_processing_delay = config.PROCESSING_DELAY
-    current_use_group = getattr(config, 'USE_GROUP', False)
+    runtime = runtime_settings.load()
     return config
 
-def render_progress_bar(current: int, total: int, length: int = 10) -> str:
+_CONFIG_PATH = config.__file__
+_config_mtime = os.path.getmtime(_CONFIG_PATH)
+
+def reload_config_if_changed():
+    """Перезагружает config.py, только если файл изменился с момента последней загрузки."""
+    global _config_mtime
+    mtime = os.path.getmtime(_CONFIG_PATH)
+    if mtime > _config_mtime:
+        _config_mtime = mtime
+        reload_config()
+
+_MAX_LOG_TEXT_LEN = 3900  # запас до лимита Telegram в 4096 символов
+_BAR_LENGTH = 10
+_BAR_FULL = "■" * _BAR_LENGTH
+_BAR_EMPTY = "□" * _BAR_LENGTH
+
+def render_progress_bar(current: int, total: int, length: int = _BAR_LENGTH) -> str:
     """Создаёт визуальный прогресс-бар."""
+    if length != _BAR_LENGTH:
+        if total == 0:
+            return "□" * length
+        filled = current * length // total
+        return "■" * filled + "□" * (length - filled)
     if total == 0:
-        return "□" * length
-    filled = int(current / total * length)
-    return "■" * filled + "□" * (length - filled)
+        return _BAR_EMPTY
+    filled = current * length // total
+    return _BAR_FULL[:filled] + _BAR_EMPTY[filled:]
 
 def render_log_text(state: Dict) -> str:
     """Форматирует лог с прогресс-барами и последними сообщениями."""
-    lines = state.get("messages", [])[-config.MAX_LINES_IN_LOG:]
+    lines = state.get("messages") or ()
     total = state.get("total", 0)
     downloaded = state.get("downloaded", 0)
     published = state.get("published", 0)
@@ -67,47 +105,61 @@ def render_log_text(state: Dict) -> str:
         f"{'─'*17}\n"
     )
 
-    body = "\n".join(f"{html.escape(line)}" for line in lines)
-    result = f"{header}<pre>{body}</pre>"
-
-    if len(result) > 3900:
-        result = "…\n" + result[-3800:]
-    return result
-
-def update_config_file(top_count: int, processing_delay: int, use_group: bool = None):
-    """Обновляет значения TOP_COUNT, PROCESSING_DELAY и опционально USE_GROUP в config.py."""
-    config_path = "config.py"
+    body = html.escape("\n".join(lines))
+    budget = _MAX_LOG_TEXT_LEN - len(header) - len("<pre></pre>")
+    if len(body) > budget:
+        # Отбрасываем целые строки с начала, чтобы не разрезать HTML-сущность посреди
+        start = body.find("\n", len(body) - budget + len("…\n"))
+        if start != -1:
+            body = "…\n" + body[start + 1:]
+        else:
+            # Одна слишком длинная строка: режем уже экранированный текст, а если разрез
+            # попал внутрь сущности (&amp; и т.п.), отбрасываем её остаток до ';'
+            cut = len(body) - (budget - len("…"))
+            amp = body.rfind("&", 0, cut)
+            semi = body.find(";", amp) if amp != -1 else -1
+            if semi >= cut:
+                cut = semi + 1
+            body = "…" + body[cut:]
+    return f"{header}<pre>{body}</pre>"
+
+async def send_error(chat_id: int, prefix: str, error: Exception):
+    """Отправляет текст исключения без HTML-разметки, обрезанный до лимита Telegram."""
+    text = f"{prefix}: {error}"[:_MAX_LOG_TEXT_LEN]
+    await bot.send_message(chat_id, text, parse_mode=None)
+
+# Создаётся при первом сохранении: до Python 3.10 Lock привязывается к циклу событий в момент создания,
+# а на импорте модуля цикла asyncio.run(main()) ещё нет
+_save_lock: Optional[asyncio.Lock] = None
+
+async def save_settings():
+    """Сохраняет текущие TOP_COUNT, PROCESSING_DELAY и USE_GROUP в settings.json, не блокируя event loop."""
+    global _save_lock
+    if _save_lock is None:
+        _save_lock = asyncio.Lock()
     try:
-        with open(config_path, "r", encoding="utf-8") as f:
-            content = f.read()
-        
-        content = re.sub(r"TOP_COUNT\s*=\s*\d+", f"TOP_COUNT = {top_count}", content)
-        content = re.sub(r"PROCESSING_DELAY\s*=\s*\d+", f"PROCESSING_DELAY = {processing_delay}", content)
-        if use_group is not None:
-            content = re.sub(r"USE_GROUP\s*=\s*(True|False)", f"USE_GROUP = {use_group}", content)
-        
-        with open(config_path, "w", encoding="utf-8") as f:
-            f.write(content)
-        reload_config()
+        async with _save_lock:  # все сохранения пишут через один и тот же временный файл
+            await asyncio.to_thread(runtime.save)
     except Exception as e:
-        print(f"Ошибка при обновлении config.py: {e}")
-        bot.send_message(config.ADMIN_CHAT_ID, f"💥 Ошибка при обновлении config.py: {str(e)}")
-
-def get_settings_menu() -> InlineKeyboardMarkup:
-    """Создаёт меню настроек с текущими значениями и кнопками для изменения TOP_COUNT, PROCESSING_DELAY и режима публикации."""
-    global current_top_count, current_processing_delay, current_use_group
-    mode_text = "Сообщество" if current_use_group else "Профиль"
+        logger.exception(f"Error saving {runtime_settings.SETTINGS_PATH}")
+        if config.ADMIN_CHAT_ID:
+            await send_error(config.ADMIN_CHAT_ID, f"💥 Ошибка при сохранении {runtime_settings.SETTINGS_PATH}", e)
+
+@lru_cache(maxsize=128)
+def _build_settings_menu(top_count: int, processing_delay: int, use_group: bool) -> InlineKeyboardMarkup:
+    """Собирает клавиатуру настроек; кешируется по набору значений, т.к. разметка не меняется."""
+    mode_text = "Сообщество" if use_group else "Профиль"
     return InlineKeyboardMarkup(
         inline_keyboard=[
-            [InlineKeyboardButton(text=f"Настройки: TOP_COUNT={current_top_count}, PROCESSING_DELAY={current_processing_delay}с", callback_data="noop")],
+            [InlineKeyboardButton(text=f"Настройки: TOP_COUNT={top_count}, PROCESSING_DELAY={processing_delay}с", callback_data="noop")],
             [
                 InlineKeyboardButton(text="⬅️ -1", callback_data="decrease_top_count"),
-                InlineKeyboardButton(text=f"Видео: {current_top_count}", callback_data="noop"),
+                InlineKeyboardButton(text=f"Видео: {top_count}", callback_data="noop"),
                 InlineKeyboardButton(text="+1 ➡️", callback_data="increase_top_count")
             ],
             [
                 InlineKeyboardButton(text="⬅️ -20с", callback_data="decrease_delay"),
-                InlineKeyboardButton(text=f"Задержка: {current_processing_delay}с", callback_data="noop"),
+                InlineKeyboardButton(text=f"Задержка: {processing_delay}с", callback_data="noop"),
                 InlineKeyboardButton(text="+20с ➡️", callback_data="increase_delay")
             ],
             [InlineKeyboardButton(text="⏱ Авто (час на TOP_COUNT)", callback_data="auto_delay")],
@@ -116,6 +168,11 @@ def get_settings_menu() -> InlineKeyboardMarkup:
         ]
     )
 
+def get_settings_menu() -> InlineKeyboardMarkup:
+    """Возвращает меню настроек с текущими значениями и кнопками для изменения TOP_COUNT, PROCESSING_DELAY и режима публикации."""
+    return _build_settings_menu(runtime.top_count, runtime.processing_delay, runtime.use_group)
+
+@lru_cache(maxsize=1)
 def get_main_menu() -> InlineKeyboardMarkup:
     """Создаёт главное меню с кнопками 'Запостить ещё' и 'Изменить настройки'."""
     return InlineKeyboardMarkup(
@@ -127,52 +184,132 @@ def get_main_menu() -> InlineKeyboardMarkup:
         ]
     )
 
+def _edit_lock(entry: Dict) -> asyncio.Lock:
+    """Возвращает блокировку правок чата, создавая её при первом обращении (внутри работающего цикла)."""
+    lock = entry.get("edit_lock")
+    if lock is None:
+        lock = entry["edit_lock"] = asyncio.Lock()
+    return lock
+
 async def update_log_message(chat_id: int, text: str, menu: InlineKeyboardMarkup = None):
-    """Создаёт или обновляет сообщение с логом, избегая ошибки 'message is not modified'."""
-    kb = menu or get_main_menu()
-    entry = log_status.get(chat_id)
+    """Создаёт или обновляет сообщение с логом, избегая ошибки 'message is not modified'.
+
+    Правки одного чата идут строго по очереди: иначе более старая правка, ещё висящая
+    в запросе, может прийти в Telegram после свежей и затереть её.
+    """
+    entry = log_status.setdefault(chat_id, {})
+    async with _edit_lock(entry):
+        await _update_log_message(chat_id, entry, text, menu or get_main_menu())
 
-    if not entry or "message_id" not in entry:
+async def _update_log_message(chat_id: int, entry: Dict, text: str, kb: InlineKeyboardMarkup):
+    if "message_id" not in entry:
         msg = await bot.send_message(chat_id, text, reply_markup=kb)
-        log_status[chat_id] = {
+        # Обновляем на месте, чтобы не потерять флаги (busy и т.п.), выставленные до первой отправки
+        entry.setdefault("busy", False)
+        entry.setdefault("last_state", {})
+        entry.setdefault("use_auto_delay", False)
+        entry.update({
             "message_id": msg.message_id,
             "last_text": text,
             "last_reply_markup": kb,
-            "busy": False,
-            "last_state": {},
-            "use_auto_delay": False
-        }
-    else:
-        # Проверяем, изменились ли текст или клавиатура
-        if text != entry.get("last_text") or str(kb.inline_keyboard) != str(entry.get("last_reply_markup", {}).inline_keyboard):
-            try:
-                await bot.edit_message_text(
-                    chat_id=chat_id,
-                    message_id=entry["message_id"],
-                    text=text,
-                    reply_markup=kb
-                )
-                entry["last_text"] = text
-                entry["last_reply_markup"] = kb
-            except TelegramBadRequest as e:
-                if "message is not modified" in str(e):
-                    pass  # Игнорируем ошибку, если сообщение не изменилось
-                else:
-                    raise  # Пробрасываем другие ошибки
-            except Exception as e:
-                logger.error(f"Error updating message: {e}")
+        })
+        return
+
+    # Клавиатуры кешируются, поэтому обычно хватает сравнения по идентичности;
+    # если ни текст, ни клавиатура не изменились — не тратим запрос к Telegram
+    last_kb = entry.get("last_reply_markup")
+    if text == entry.get("last_text") and (kb is last_kb or (last_kb is not None and kb == last_kb)):
+        return
+
+    try:
+        await bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=entry["message_id"],
+            text=text,
+            reply_markup=kb
+        )
+    except TelegramRetryAfter as e:
+        # Flood control: запоминаем, сколько Telegram просит подождать, вместо повторов вслепую
+        entry["cooldown_until"] = asyncio.get_running_loop().time() + e.retry_after
+        logger.warning(f"Flood control for chat {chat_id}, retry after {e.retry_after}s")
+        return
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise  # Пробрасываем другие ошибки
+    except Exception as e:
+        logger.error(f"Error updating message: {e}")
+        return
+    entry["last_text"] = text
+    entry["last_reply_markup"] = kb
 
 def progress_callback_factory(chat_id: int):
-    """Создаёт функцию для обновления лога."""
-    async def _cb(state: Dict):
-        text = render_log_text(state)
-        log_status[chat_id]["last_state"] = state
+    """Создаёт функцию для обновления лога.
+
+    Правки сообщения троттлятся: не чаще раза в EDIT_MIN_INTERVAL, промежуточные
+    состояния схлопываются в последнее, на стадии "done" лог отправляется сразу.
+    Пока действует flood control от Telegram (cooldown_until), правки откладываются.
+    """
+    async def _flush():
+        entry = log_status[chat_id]
+        text = entry.pop("pending_text", None)
+        if text is None:
+            return
+        loop = asyncio.get_running_loop()
+        entry["last_edit_ts"] = loop.time()
         await update_log_message(chat_id, text)
+        cooldown = entry.get("cooldown_until", 0.0) - loop.time()
+        if cooldown > 0 and not entry.get("flush_task"):
+            # Правку отклонили по flood control — повторим после паузы с самым свежим текстом
+            entry.setdefault("pending_text", text)
+            entry["flush_task"] = asyncio.create_task(_flush_later(cooldown))
+
+    async def _flush_later(delay: float):
+        await asyncio.sleep(delay)
+        log_status[chat_id]["flush_task"] = None
+        await _flush()
+
+    async def _cb(state: Dict):
+        entry = log_status.setdefault(chat_id, {})
+        entry["last_state"] = state
+        messages = state.get("messages")
+        # Всё, что попадает в текст лога; если ничего не изменилось — не перерисовываем и не правим сообщение
+        render_key = (
+            state.get("stage"),
+            state.get("total"),
+            state.get("downloaded"),
+            state.get("published"),
+            state.get("failed"),
+            len(messages) if messages else 0,
+            messages[-1] if messages else None,
+        )
+        if entry.get("render_key") == render_key:
+            return
+        entry["render_key"] = render_key
+        entry["pending_text"] = render_log_text(state)
+
+        now = asyncio.get_running_loop().time()
+        cooldown = entry.get("cooldown_until", 0.0) - now
+        if state.get("stage") == "done":
+            task = entry.pop("flush_task", None)
+            if task:
+                task.cancel()
+            if cooldown > 0:
+                entry["flush_task"] = asyncio.create_task(_flush_later(cooldown))
+            else:
+                await _flush()
+            return
+
+        if entry.get("flush_task"):
+            return  # отправка уже запланирована, она возьмёт свежий текст
+        delay = max(EDIT_MIN_INTERVAL - (now - entry.get("last_edit_ts", 0.0)), cooldown)
+        if delay <= 0:
+            await _flush()
+        else:
+            entry["flush_task"] = asyncio.create_task(_flush_later(delay))
     return _cb
 
 async def run_cycle_for_chat(chat_id: int):
     """Запускает цикл обработки с текущим TOP_COUNT и PROCESSING_DELAY."""
-    global current_top_count, current_processing_delay, current_use_group
     entry = log_status.setdefault(chat_id, {})
     if entry.get("busy"):
         await bot.send_message(chat_id, "⏳ Уже выполняется задача, дождитесь завершения.")
@@ -180,179 +317,128 @@ async def run_cycle_for_chat(chat_id: int):
 
     entry["busy"] = True
     try:
-        reload_config()
-        worker.TOP_COUNT = current_top_count
-        worker.group_id = config.GROUP_ID if current_use_group else None
-        if entry.get("use_auto_delay", False) and current_top_count > 0:
-            worker.PROCESSING_DELAY = 3600 // current_top_count
+        reload_config_if_changed()
+        worker.TOP_COUNT = runtime.top_count
+        worker.MAX_LINES_IN_LOG = config.MAX_LINES_IN_LOG
+        worker.group_id = config.GROUP_ID if runtime.use_group else None
+        if entry.get("use_auto_delay", False) and runtime.top_count > 0:
+            worker.PROCESSING_DELAY = 3600 // runtime.top_count
             await bot.send_message(chat_id, f"⏱ Используется авто-задержка: {worker.PROCESSING_DELAY}с на видео")
         else:
-            worker.PROCESSING_DELAY = current_processing_delay
+            worker.PROCESSING_DELAY = runtime.processing_delay
         cb = progress_callback_factory(chat_id)
         await worker.run_cycle(cb)
     except Exception as e:
-        await bot.send_message(chat_id, f"💥 Ошибка: {str(e)}")
+        await send_error(chat_id, "💥 Ошибка", e)
     finally:
         entry["busy"] = False
         entry["use_auto_delay"] = False
 
-@dp.message(Command("start"))
+async def _refresh_settings_view(query: CallbackQuery):
+    """Перерисовывает меню настроек в сообщении, из которого пришёл callback."""
+    entry = log_status.setdefault(query.message.chat.id, {})
+    # Под той же блокировкой, что и правки лога: иначе last_text может оказаться устаревшим
+    async with _edit_lock(entry):
+        text = entry.get("last_text") or render_log_text(entry.get("last_state", {})) or "⚙️ Настройки"
+        kb = get_settings_menu()
+        try:
+            await bot.edit_message_text(
+                chat_id=query.message.chat.id,
+                message_id=query.message.message_id,
+                text=text,
+                reply_markup=kb
+            )
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                raise
+        if entry.get("message_id") == query.message.message_id:
+            entry["last_text"] = text
+            entry["last_reply_markup"] = kb
+
+@admin_router.message(Command("start"))
 async def start_cmd(message: Message):
     """Обрабатывает команду /start, показывая меню настроек."""
-    if config.ADMIN_CHAT_ID and message.chat.id != config.ADMIN_CHAT_ID:
-        await message.answer("🚫 Доступ ограничен.")
-        return
-    reload_config()
     text = "🤖 Бот готов! Используйте /run или кнопку «Запостить ещё» для запуска цикла.\n⚙️ Настройки:"
     await update_log_message(message.chat.id, text, get_settings_menu())
 
-@dp.message(Command("run"))
+@admin_router.message(Command("run"))
 async def run_cmd(message: Message):
     """Обрабатывает команду /run, запуская цикл обработки."""
-    if config.ADMIN_CHAT_ID and message.chat.id != config.ADMIN_CHAT_ID:
-        await message.answer("🚫 Доступ ограничен.")
-        return
     await run_cycle_for_chat(message.chat.id)
 
-@dp.callback_query(F.data == "restart")
+@admin_router.callback_query(F.data == "restart")
 async def restart_btn(query: CallbackQuery):
     """Обрабатывает кнопку 'Запостить ещё'."""
-    if config.ADMIN_CHAT_ID and query.message.chat.id != config.ADMIN_CHAT_ID:
-        return
     await query.answer("🔁 Запускаю новый цикл...")
     await run_cycle_for_chat(query.message.chat.id)
 
-@dp.callback_query(F.data == "change_settings")
+@admin_router.callback_query(F.data == "change_settings")
 async def change_settings_btn(query: CallbackQuery):
     """Обрабатывает кнопку 'Изменить настройки'."""
-    if config.ADMIN_CHAT_ID and query.message.chat.id != config.ADMIN_CHAT_ID:
-        return
-    reload_config()
     await query.answer("⚙️ Открываю настройки")
-    text = render_log_text(log_status.get(query.message.chat.id, {}).get("last_state", {}))
-    await bot.edit_message_text(
-        chat_id=query.message.chat.id,
-        message_id=query.message.message_id,
-        text=text or "⚙️ Настройки",
-        reply_markup=get_settings_menu()
-    )
+    await _refresh_settings_view(query)
 
-@dp.callback_query(F.data == "decrease_top_count")
+@admin_router.callback_query(F.data == "decrease_top_count")
 async def decrease_top_count_btn(query: CallbackQuery):
-    """Уменьшает TOP_COUNT на 1 и обновляет config.py."""
-    global current_top_count
-    if config.ADMIN_CHAT_ID and query.message.chat.id != config.ADMIN_CHAT_ID:
-        return
-    if current_top_count > 1:
-        current_top_count -= 1
-        update_config_file(current_top_count, current_processing_delay)
-        await query.answer(f"TOP_COUNT уменьшен до {current_top_count}")
+    """Уменьшает TOP_COUNT на 1 и сохраняет настройки."""
+    if runtime.top_count > 1:
+        runtime.top_count -= 1
+        await save_settings()
+        await query.answer(f"TOP_COUNT уменьшен до {runtime.top_count}")
     else:
         await query.answer("TOP_COUNT не может быть меньше 1")
-    text = render_log_text(log_status.get(query.message.chat.id, {}).get("last_state", {}))
-    await bot.edit_message_text(
-        chat_id=query.message.chat.id,
-        message_id=query.message.message_id,
-        text=text or "⚙️ Настройки",
-        reply_markup=get_settings_menu()
-    )
+    await _refresh_settings_view(query)
 
-@dp.callback_query(F.data == "increase_top_count")
+@admin_router.callback_query(F.data == "increase_top_count")
 async def increase_top_count_btn(query: CallbackQuery):
-    """Увеличивает TOP_COUNT на 1 и обновляет config.py."""
-    global current_top_count
-    if config.ADMIN_CHAT_ID and query.message.chat.id != config.ADMIN_CHAT_ID:
-        return
-    current_top_count += 1
-    update_config_file(current_top_count, current_processing_delay)
-    await query.answer(f"TOP_COUNT увеличен до {current_top_count}")
-    text = render_log_text(log_status.get(query.message.chat.id, {}).get("last_state", {}))
-    await bot.edit_message_text(
-        chat_id=query.message.chat.id,
-        message_id=query.message.message_id,
-        text=text or "⚙️ Настройки",
-        reply_markup=get_settings_menu()
-    )
+    """Увеличивает TOP_COUNT на 1 и сохраняет настройки."""
+    runtime.top_count += 1
+    await save_settings()
+    await query.answer(f"TOP_COUNT увеличен до {runtime.top_count}")
+    await _refresh_settings_view(query)
 
-@dp.callback_query(F.data == "decrease_delay")
+@admin_router.callback_query(F.data == "decrease_delay")
 async def decrease_delay_btn(query: CallbackQuery):
-    """Уменьшает PROCESSING_DELAY на 20 секунд и обновляет config.py."""
-    global current_processing_delay
-    if config.ADMIN_CHAT_ID and query.message.chat.id != config.ADMIN_CHAT_ID:
-        return
-    if current_processing_delay >= 20:
-        current_processing_delay -= 20
-        update_config_file(current_top_count, current_processing_delay)
-        await query.answer(f"PROCESSING_DELAY уменьшен до {current_processing_delay}с")
+    """Уменьшает PROCESSING_DELAY на 20 секунд и сохраняет настройки."""
+    if runtime.processing_delay >= 20:
+        runtime.processing_delay -= 20
+        await save_settings()
+        await query.answer(f"PROCESSING_DELAY уменьшен до {runtime.processing_delay}с")
     else:
         await query.answer("PROCESSING_DELAY не может быть меньше 0")
-    text = render_log_text(log_status.get(query.message.chat.id, {}).get("last_state", {}))
-    await bot.edit_message_text(
-        chat_id=query.message.chat.id,
-        message_id=query.message.message_id,
-        text=text or "⚙️ Настройки",
-        reply_markup=get_settings_menu()
-    )
+    await _refresh_settings_view(query)
 
-@dp.callback_query(F.data == "increase_delay")
+@admin_router.callback_query(F.data == "increase_delay")
 async def increase_delay_btn(query: CallbackQuery):
-    """Увеличивает PROCESSING_DELAY на 20 секунд и обновляет config.py."""
-    global current_processing_delay
-    if config.ADMIN_CHAT_ID and query.message.chat.id != config.ADMIN_CHAT_ID:
-        return
-    current_processing_delay += 20
-    update_config_file(current_top_count, current_processing_delay)
-    await query.answer(f"PROCESSING_DELAY увеличен до {current_processing_delay}с")
-    text = render_log_text(log_status.get(query.message.chat.id, {}).get("last_state", {}))
-    await bot.edit_message_text(
-        chat_id=query.message.chat.id,
-        message_id=query.message.message_id,
-        text=text or "⚙️ Настройки",
-        reply_markup=get_settings_menu()
-    )
+    """Увеличивает PROCESSING_DELAY на 20 секунд и сохраняет настройки."""
+    runtime.processing_delay += 20
+    await save_settings()
+    await query.answer(f"PROCESSING_DELAY увеличен до {runtime.processing_delay}с")
+    await _refresh_settings_view(query)
 
-@dp.callback_query(F.data == "auto_delay")
+@admin_router.callback_query(F.data == "auto_delay")
 async def auto_delay_btn(query: CallbackQuery):
     """Устанавливает флаг для автоматической задержки (1 час / TOP_COUNT)."""
-    if config.ADMIN_CHAT_ID and query.message.chat.id != config.ADMIN_CHAT_ID:
-        return
-    if current_top_count == 0:
+    if runtime.top_count == 0:
         await query.answer("TOP_COUNT должен быть больше 0 для авто-задержки")
         return
     log_status[query.message.chat.id]["use_auto_delay"] = True
-    auto_delay = 3600 // current_top_count
+    auto_delay = 3600 // runtime.top_count
     await query.answer(f"Установлена авто-задержка: {auto_delay}с на видео")
-    text = render_log_text(log_status.get(query.message.chat.id, {}).get("last_state", {}))
-    await bot.edit_message_text(
-        chat_id=query.message.chat.id,
-        message_id=query.message.message_id,
-        text=text or "⚙️ Настройки",
-        reply_markup=get_settings_menu()
-    )
+    await _refresh_settings_view(query)
 
-@dp.callback_query(F.data == "toggle_publish_mode")
+@admin_router.callback_query(F.data == "toggle_publish_mode")
 async def toggle_publish_mode_btn(query: CallbackQuery):
     """Переключает режим публикации между 'Профиль' и 'Сообщество'."""
-    global current_use_group
-    if config.ADMIN_CHAT_ID and query.message.chat.id != config.ADMIN_CHAT_ID:
-        return
-    current_use_group = not current_use_group
-    update_config_file(current_top_count, current_processing_delay, current_use_group)
-    mode_text = "Сообщество" if current_use_group else "Профиль"
+    runtime.use_group = not runtime.use_group
+    await save_settings()
+    mode_text = "Сообщество" if runtime.use_group else "Профиль"
     await query.answer(f"Режим публикации изменен на: {mode_text}")
-    text = render_log_text(log_status.get(query.message.chat.id, {}).get("last_state", {}))
-    await bot.edit_message_text(
-        chat_id=query.message.chat.id,
-        message_id=query.message.message_id,
-        text=text or "⚙️ Настройки",
-        reply_markup=get_settings_menu()
-    )
+    await _refresh_settings_view(query)
 
-@dp.callback_query(F.data == "back_to_main")
+@admin_router.callback_query(F.data == "back_to_main")
 async def back_to_main_btn(query: CallbackQuery):
     """Возвращает к главному меню."""
-    if config.ADMIN_CHAT_ID and query.message.chat.id != config.ADMIN_CHAT_ID:
-        return
     await query.answer("🔙 Возвращаюсь к главному меню")
     text = render_log_text(log_status.get(query.message.chat.id, {}).get("last_state", {}))
     await bot.edit_message_text(
@@ -362,18 +448,26 @@ async def back_to_main_btn(query: CallbackQuery):
         reply_markup=get_main_menu()
     )
 
-@dp.callback_query(F.data == "noop")
+@admin_router.callback_query(F.data == "noop")
 async def noop_btn(query: CallbackQuery):
     """Пустой callback для неинтерактивных кнопок."""
     await query.answer()
 
+@guest_router.message(Command("start", "run"))
+async def access_denied_cmd(message: Message):
+    """Отвечает на команды из чатов, которым доступ не разрешён."""
+    await message.answer("🚫 Доступ ограничен.")
+
+dp.include_routers(admin_router, guest_router)
+
 async def main():
     """Запускает бота."""
     try:
         await dp.start_polling(bot, allowed_updates=["message", "callback_query"])
     except Exception as e:
         logger.error(f"Error in main loop: {e}")
+    finally:
+        await worker.close()
 
 if __name__ == "__main__":
-    import asyncio
     asyncio.run(main())
@@ -0,0 +1,44 @@
+import os
+import json
+from dataclasses import dataclass, asdict, fields
+import config
+
+SETTINGS_PATH = "settings.json"  # изменяемые из бота настройки; config.py остаётся только для констант
+
+
+@dataclass
+class Runtime:
+    """Настройки, которые меняются кнопками бота во время работы."""
+    top_count: int
+    processing_delay: int
+    use_group: bool
+
+    def save(self, path: str = SETTINGS_PATH):
+        """Атомарно сохраняет настройки в JSON (запись во временный файл + os.replace)."""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(asdict(self), f)
+        os.replace(tmp_path, path)
+
+
+def defaults() -> Runtime:
+    """Значения по умолчанию из config.py."""
+    return Runtime(
+        top_count=config.TOP_COUNT,
+        processing_delay=config.PROCESSING_DELAY,
+        use_group=getattr(config, "USE_GROUP", False),
+    )
+
+
+def load(path: str = SETTINGS_PATH) -> Runtime:
+    """Возвращает значения из config.py, переопределённые сохранёнными в settings.json."""
+    runtime = defaults()
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return runtime
+    for field in fields(Runtime):
+        if field.name in data:
+            setattr(runtime, field.name, data[field.name])
+    return runtime
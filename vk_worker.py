@@ -3,42 +3,218 @@ import aiohttp
 import asyncio
 import shutil
 import glob
-from typing import List, Dict, Tuple, Optional
+import json
+import re
+import time
+import random
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import List, Dict, Tuple, Optional, Set
 from yt_dlp import YoutubeDL
-from config import ACCESS_TOKEN, API_VERSION, PROCESSING_DELAY, VIDEOS_DIR, TOP_COUNT, GROUP_ID
+from config import ACCESS_TOKEN, API_VERSION, PROCESSING_DELAY, VIDEOS_DIR, TOP_COUNT, GROUP_ID, MAX_LINES_IN_LOG
 import subprocess
+import threading
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
+DOWNLOAD_CONCURRENCY = 8
+# Index of uniqueized clips kept between cycles, so repeats in the top are not re-downloaded/re-encoded
+CACHE_FILE = os.path.join(VIDEOS_DIR, "cache.json")
+# Downloads are pinned to their own pool so each thread can keep a YoutubeDL instance alive
+_download_pool = ThreadPoolExecutor(max_workers=DOWNLOAD_CONCURRENCY, thread_name_prefix="ytdlp")
+_ydl_local = threading.local()
+
+_HASHTAG_RE = re.compile(r"#\w+")
+_DESCRIPTION_HEADER = "ПОДПИШИТЕСЬ НА ЛУЧШИЕ МЕМЫ"
+
+VK_TOO_MANY_REQUESTS = 6
+VK_FLOOD_CONTROL = 9
+
+class VKAPIError(Exception):
+    def __init__(self, code: Optional[int], message: str):
+        super().__init__(f"VK API error: {message}")
+        self.code = code
+
+class CircuitOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+    """Opens after `fail_threshold` consecutive failures and rejects calls for `reset_timeout` seconds.
+
+    Once the timeout passes it is half-open: calls go through again, the first success
+    closes it, and another failure re-opens it for a new timeout.
+    """
+
+    def __init__(self, fail_threshold: int = 5, reset_timeout: float = 60):
+        self.fail_threshold = fail_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+
+    def allow(self) -> bool:
+        if self._opened_at is None:
+            return True
+        return time.monotonic() - self._opened_at >= self.reset_timeout
+
+    def record_success(self):
+        self._failures = 0
+        self._opened_at = None
+
+    def record_failure(self):
+        self._failures += 1
+        if self._failures >= self.fail_threshold:
+            self._opened_at = time.monotonic()
+            logger.warning(f"VK API circuit opened for {self.reset_timeout}s")
+
+async def _gather_or_cancel(*aws):
+    """Like asyncio.gather, but on the first failure (or cancellation) cancels the remaining
+    tasks and waits for them to finish, as asyncio.TaskGroup does on Python 3.11+."""
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+class _Debouncer:
+    """Coalesces progress callbacks: at most one call per `delay` seconds, always with the latest state."""
+
+    def __init__(self, callback, delay: float = 0.2):
+        self._callback = callback
+        self._delay = delay
+        self._state = None
+        self._task: Optional[asyncio.Task] = None  # waiting out the delay
+        self._running: Optional[asyncio.Task] = None  # callback in progress
+
+    def schedule(self, state: Dict):
+        self._state = state
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        await asyncio.sleep(self._delay)
+        self._task = None
+        self._running = asyncio.current_task()
+        try:
+            await self._callback(self._state)
+        except Exception as e:
+            logger.error(f"Progress callback error: {e}")
+        finally:
+            if self._running is asyncio.current_task():
+                self._running = None
+
+    async def flush(self, state: Dict):
+        """Cancels a pending call and reports `state` right away (used for final states).
+
+        A call that is already running is awaited first, so it cannot land after the final state.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._running is not None:
+            await asyncio.wait({self._running})
+        await self._callback(state)
+
 class VKWorker:
+    # Defaults from config.py; the bot overrides them on the instance before each cycle
+    TOP_COUNT = TOP_COUNT
+    PROCESSING_DELAY = PROCESSING_DELAY
+    MAX_LINES_IN_LOG = MAX_LINES_IN_LOG
+    API_RETRIES = 3
+    API_BACKOFF_BASE = 1.0  # seconds
+    API_BACKOFF_CAP = 30.0
+
     def __init__(self, access_token: str = ACCESS_TOKEN, api_version: str = API_VERSION, group_id: Optional[int] = GROUP_ID):
         if not access_token or not api_version:
             raise ValueError("access_token and api_version must be provided")
         self.access_token = access_token
         self.api_version = api_version
         self.group_id = group_id
+        # Built once; every API call only merges its own params on top
+        self._base_url = "https://api.vk.com/method/"
+        self._auth = {"access_token": access_token, "v": api_version}
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._breaker = CircuitBreaker(fail_threshold=5, reset_timeout=60)
+        self._cache: Optional[Dict[str, Dict]] = None  # "<owner_id>_<id>" -> uniqueized clip, see CACHE_FILE
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Returns the worker-wide session, creating it on first use.
+
+        One keep-alive session is shared by every run_cycle so pooled connections to
+        api.vk.com are reused instead of paying a TCP + TLS handshake per cycle
+        (see aiohttp's client reference on connection pooling).
+        """
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=64, limit_per_host=16, ttl_dns_cache=300,
+                    keepalive_timeout=60, enable_cleanup_closed=True,
+                ),
+                # No total limit: uploads of large clips can legitimately take minutes
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=60),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def __aenter__(self) -> "VKWorker":
+        self._get_session()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def _api_request(self, session: aiohttp.ClientSession, http_method: str, method: str, params: Dict) -> Dict:
+        """Calls a VK API method, retrying throttling errors with jittered exponential backoff.
+
+        Repeated flood control trips the shared circuit breaker, after which calls fail fast
+        until it lets a trial request through. Network errors are retried only for GET,
+        since POST methods (create/publish) are not safe to repeat blindly.
+        """
+        url = self._base_url + method
+        full = {**self._auth, **params}
+        for attempt in range(self.API_RETRIES + 1):
+            if not self._breaker.allow():
+                raise CircuitOpenError(f"VK API circuit open after repeated flood control, skipping {method}")
+            last_attempt = attempt == self.API_RETRIES
+            try:
+                async with session.request(http_method, url, params=full) as resp:
+                    resp.raise_for_status()
+                    data = await resp.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if http_method != "GET" or last_attempt:
+                    raise
+                data = None
+            if data is not None:
+                if "error" not in data:
+                    self._breaker.record_success()
+                    return data
+                error = data["error"]
+                code = error.get("error_code")
+                if code == VK_FLOOD_CONTROL or "Flood control" in error.get("error_msg", ""):
+                    self._breaker.record_failure()
+                elif code != VK_TOO_MANY_REQUESTS:
+                    raise VKAPIError(code, error.get("error_msg", ""))
+                if last_attempt:
+                    raise VKAPIError(code, error.get("error_msg", ""))
+            # Full jitter keeps concurrent tasks from retrying in lockstep
+            delay = min(self.API_BACKOFF_CAP, self.API_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.5)
+            logger.warning(f"{method} failed (attempt {attempt + 1}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
 
     async def _api_get(self, session: aiohttp.ClientSession, method: str, params: Dict) -> Dict:
-        url = f"https://api.vk.com/method/{method}"
-        full = {"access_token": self.access_token, "v": self.api_version, **params}
-        async with session.get(url, params=full) as resp:
-            resp.raise_for_status()
-            data = await resp.json()
-            if "error" in data:
-                raise Exception(f"VK API error: {data['error']['error_msg']}")
-            return data
+        return await self._api_request(session, "GET", method, params)
 
     async def _api_post(self, session: aiohttp.ClientSession, method: str, params: Dict) -> Dict:
-        url = f"https://api.vk.com/method/{method}"
-        full = {"access_token": self.access_token, "v": self.api_version, **params}
-        async with session.post(url, params=full) as resp:
-            resp.raise_for_status()
-            data = await resp.json()
-            if "error" in data:
-                raise Exception(f"VK API error: {data['error']['error_msg']}")
-            return data
+        return await self._api_request(session, "POST", method, params)
 
     async def get_top_videos(self, session: aiohttp.ClientSession, count: int = TOP_COUNT) -> List[Dict]:
         try:
@@ -48,27 +224,43 @@ class VKWorker:
             logger.error(f"Error fetching top videos: {e}")
             return []
 
+    @staticmethod
+    def _get_ydl(out_dir: str) -> YoutubeDL:
+        """Returns this thread's YoutubeDL for out_dir, so extractors are not rebuilt for every URL."""
+        instances = getattr(_ydl_local, "instances", None)
+        if instances is None:
+            instances = _ydl_local.instances = {}
+        ydl = instances.get(out_dir)
+        if ydl is None:
+            ydl_opts = {
+                # VK serves progressive MP4s, so prefer one directly and skip any merge step
+                "format": "best[ext=mp4]/best",
+                "outtmpl": os.path.join(out_dir, "%(id)s.%(ext)s"),
+                "quiet": True,
+                "noprogress": True,
+                "nooverwrites": True,
+                "writethumbnail": False,
+                "writesubtitles": False,
+                "concurrent_fragment_downloads": 4,
+                "http_chunk_size": 10 * 1024 * 1024,
+                "extractor_retries": 2,
+                "socket_timeout": 15,
+            }
+            ydl = instances[out_dir] = YoutubeDL(ydl_opts)
+        return ydl
+
     @staticmethod
     def _ydl_download(url: str, out_dir: str) -> Optional[Tuple[str, Dict]]:
-        """Synchronous download via yt-dlp; run in a separate thread via asyncio.to_thread."""
-        try:
-            from yt_dlp import YoutubeDL
-        except ImportError:
-            raise ImportError("yt-dlp is not installed. Please install it using 'pip install yt-dlp'")
-        
-        ydl_opts = {
-            "format": "best",
-            "outtmpl": os.path.join(out_dir, "%(id)s.%(ext)s"),
-            "quiet": True,
-            "nooverwrites": True,
-        }
+        """Synchronous download via yt-dlp; run on the download pool."""
         try:
-            with YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                if info.get("duration", 0) > 60:
-                    logger.warning(f"Video too long: {info.get('duration')} seconds")
-                    return None
-                filepath = ydl.prepare_filename(info)
+            ydl = VKWorker._get_ydl(out_dir)
+            # Probe metadata first so clips that are too long are skipped without downloading them
+            info = ydl.extract_info(url, download=False)
+            if (info.get("duration") or 0) > 60:
+                logger.warning(f"Video too long: {info.get('duration')} seconds")
+                return None
+            info = ydl.process_ie_result(info, download=True)
+            filepath = ydl.prepare_filename(info)
             files = glob.glob(os.path.splitext(filepath)[0] + ".*")
             if not files:
                 return None
@@ -79,7 +271,8 @@ class VKWorker:
 
     async def download_one(self, url: str, out_dir: str) -> Tuple[Optional[str], Optional[Dict], Optional[str]]:
         try:
-            result = await asyncio.to_thread(self._ydl_download, url, out_dir)
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(_download_pool, self._ydl_download, url, out_dir)
             if not result:
                 return None, None, "file_not_found_after_download"
             path, meta = result
@@ -87,42 +280,224 @@ class VKWorker:
         except Exception as e:
             return None, None, str(e)
 
-    @staticmethod
-    def _uniqueize_video(path: str) -> Optional[str]:
-        """Synchronous video uniqueization via ffmpeg; run in a separate thread."""
-        if not shutil.which("ffmpeg"):
-            raise EnvironmentError("ffmpeg is not installed or not found in PATH")
+    # Filters that make the re-encoded clip differ from the original; they run on CPU frames.
+    _UNIQUEIZE_VF = "eq=brightness=0.005,noise=alls=1:allf=t"
+    _FFMPEG = ['ffmpeg', '-hide_banner', '-nostats', '-loglevel', 'error']
+    _STDERR_TAIL = 4096  # bytes of ffmpeg stderr kept for error messages
+    _nvenc_available: Optional[bool] = None
+    _ffmpeg_found = False
+    # Consumer NVIDIA drivers cap concurrent NVENC sessions; extra encodes would fail and drop to libx264
+    NVENC_SESSIONS = 3
+    _nvenc_slots: Optional[asyncio.Semaphore] = None
+    _nvenc_acquire: Optional[asyncio.Lock] = None
+
+    @classmethod
+    def _get_nvenc_slots(cls) -> asyncio.Semaphore:
+        """Returns the process-wide NVENC semaphore, creating it on first use.
+
+        Created lazily so it binds to the running loop: before Python 3.10 a semaphore
+        made at import time belongs to a different loop than the one asyncio.run starts.
+        """
+        if cls._nvenc_slots is None:
+            cls._nvenc_slots = asyncio.Semaphore(cls.NVENC_SESSIONS)
+            cls._nvenc_acquire = asyncio.Lock()
+        return cls._nvenc_slots
+
+    @classmethod
+    @asynccontextmanager
+    async def _nvenc_sessions(cls, count: int = 1):
+        """Holds `count` NVENC slots (at most NVENC_SESSIONS) for the duration of the block."""
+        slots = cls._get_nvenc_slots()
+        acquired = 0
+        try:
+            # Multi-slot holders take their slots one at a time under a lock, so two batches
+            # can never each hold part of the semaphore and wait on each other forever
+            async with cls._nvenc_acquire:
+                for _ in range(count):
+                    await slots.acquire()
+                    acquired += 1
+            yield
+        finally:
+            for _ in range(acquired):
+                slots.release()
+
+    @classmethod
+    async def _run_ffmpeg(cls, args: List[str]):
+        """Runs ffmpeg without blocking the loop; raises CalledProcessError with the stderr tail on failure."""
+        proc = await asyncio.create_subprocess_exec(
+            *args, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+        )
         try:
-            base, ext = os.path.splitext(path)
-            unique_path = f"{base}_unique{ext}"
-            subprocess.run([
-                'ffmpeg', '-i', path,
-                '-vf', 'eq=brightness=0.005,noise=alls=1:allf=t',
-                '-af', 'atempo=1.001',
-                '-c:v', 'libx264', '-preset', 'fast', '-crf', '23',
+            # Keep draining stderr so ffmpeg never blocks on a full pipe, but only remember the tail
+            tail = b""
+            while chunk := await proc.stderr.read(65536):
+                tail = (tail + chunk)[-cls._STDERR_TAIL:]
+            returncode = await proc.wait()
+        except BaseException:
+            # Cancelled (e.g. by a wait_for timeout or a failed pipeline): don't leave ffmpeg running
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            raise
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, args, stderr=tail.decode(errors="replace"))
+
+    @classmethod
+    async def _check_ffmpeg_installed(cls) -> bool:
+        """Looks ffmpeg up in PATH off the loop; only a hit is cached, so installing it later needs no restart."""
+        if not cls._ffmpeg_found:
+            cls._ffmpeg_found = await asyncio.to_thread(shutil.which, "ffmpeg") is not None
+        return cls._ffmpeg_found
+
+    @classmethod
+    async def _check_nvenc_available(cls) -> bool:
+        """One-shot probe for a working NVENC encoder; the result is cached on the class."""
+        if cls._nvenc_available is None:
+            try:
+                # `ffmpeg -encoders` lists h264_nvenc whenever it is compiled in, so encode a tiny test clip instead
+                await asyncio.wait_for(cls._run_ffmpeg([
+                    *cls._FFMPEG, '-f', 'lavfi', '-i', 'color=c=black:s=256x256:d=0.1',
+                    '-c:v', 'h264_nvenc', '-f', 'null', '-'
+                ]), timeout=30)
+                cls._nvenc_available = True
+            except Exception:
+                cls._nvenc_available = False
+            logger.info(f"NVENC available: {cls._nvenc_available}")
+        return cls._nvenc_available
+
+    @staticmethod
+    def _codec_args(use_nvenc: bool) -> Tuple[List[str], List[str]]:
+        """Returns (per-input hwaccel args, video encoder args)."""
+        if use_nvenc:
+            # Decode on the GPU, apply the CPU filters to the downloaded frames, encode with NVENC
+            return ['-hwaccel', 'cuda'], ['-c:v', 'h264_nvenc', '-preset', 'p4', '-tune', 'll', '-rc', 'vbr', '-cq', '23']
+        # The clip only has to differ from the original, so trade quality for a ~4x faster CPU encode
+        return [], [
+            '-c:v', 'libx264', '-preset', 'ultrafast', '-tune', 'zerolatency', '-crf', '28',
+            '-x264-params', 'ref=1:bframes=0'
+        ]
+
+    @staticmethod
+    def _unique_path(path: str) -> str:
+        base, ext = os.path.splitext(path)
+        return f"{base}_unique{ext}"
+
+    @classmethod
+    def _uniqueize_args(cls, path: str, unique_path: str, use_nvenc: bool) -> List[str]:
+        hwaccel, video = cls._codec_args(use_nvenc)
+        return [
+            *cls._FFMPEG, *hwaccel, '-i', path,
+            '-vf', cls._UNIQUEIZE_VF,
+            '-af', 'atempo=1.001',
+            *video,
+            '-c:a', 'aac', '-b:a', '128k',
+            '-movflags', '+faststart',
+            '-y', unique_path
+        ]
+
+    @classmethod
+    def _uniqueize_batch_args(cls, paths: List[str], unique_paths: List[str], use_nvenc: bool) -> List[str]:
+        """One ffmpeg graph for several clips: input i is filtered to [v{i}]/[a{i}] and written to output i."""
+        hwaccel, video = cls._codec_args(use_nvenc)
+        args = [*cls._FFMPEG, '-y']
+        for path in paths:
+            args += [*hwaccel, '-i', path]
+        graph = ";".join(
+            f"[{i}:v]{cls._UNIQUEIZE_VF}[v{i}];[{i}:a]atempo=1.001[a{i}]" for i in range(len(paths))
+        )
+        args += ['-filter_complex', graph]
+        for i, unique_path in enumerate(unique_paths):
+            args += [
+                '-map', f'[v{i}]', '-map', f'[a{i}]',
+                *video,
                 '-c:a', 'aac', '-b:a', '128k',
                 '-movflags', '+faststart',
-                '-y', unique_path
-            ], check=True, capture_output=True)
-            if os.path.exists(unique_path) and os.path.getsize(unique_path) > 0:
-                os.remove(path)
-                return unique_path
-            return None
-        except Exception as e:
+                unique_path
+            ]
+        return args
+
+    @staticmethod
+    def _take_unique(path: str, unique_path: str) -> Optional[str]:
+        """Replaces the source with its uniqueized copy if ffmpeg produced a non-empty file."""
+        if os.path.exists(unique_path) and os.path.getsize(unique_path) > 0:
+            os.remove(path)
+            return unique_path
+        return None
+
+    @classmethod
+    def _take_unique_result(cls, path: str, unique_path: str) -> Tuple[Optional[str], Optional[str]]:
+        """_take_unique as an (unique_path, error) pair; filesystem errors become the error."""
+        try:
+            unique_path = cls._take_unique(path, unique_path)
+        except OSError as e:
             logger.error(f"Uniqueization error: {e}")
-            return None
+            return None, str(e)
+        return (unique_path, None) if unique_path else (None, "uniqueization_failed")
 
     async def uniqueize_one(self, path: str) -> Tuple[Optional[str], Optional[str]]:
+        """Uniqueizes one clip via ffmpeg (NVENC when available)."""
+        if not await self._check_ffmpeg_installed():
+            return None, "ffmpeg is not installed or not found in PATH"
+        unique_path = self._unique_path(path)
         try:
-            unique_path = await asyncio.to_thread(self._uniqueize_video, path)
-            if not unique_path:
-                return None, "uniqueization_failed"
-            return unique_path, None
+            if await self._check_nvenc_available():
+                try:
+                    async with self._nvenc_sessions():
+                        await self._run_ffmpeg(self._uniqueize_args(path, unique_path, True))
+                except subprocess.CalledProcessError as e:
+                    logger.warning(f"NVENC encode failed, falling back to libx264: {e.stderr}")
+                    await self._run_ffmpeg(self._uniqueize_args(path, unique_path, False))
+            else:
+                await self._run_ffmpeg(self._uniqueize_args(path, unique_path, False))
+            # Filesystem calls go to a thread so slow storage does not stall the loop
+            unique_path = await asyncio.to_thread(self._take_unique, path, unique_path)
+        except subprocess.CalledProcessError as e:
+            logger.error(f"Uniqueization error: {e}: {e.stderr}")
+            return None, str(e)
         except Exception as e:
+            logger.error(f"Uniqueization error: {e}")
             return None, str(e)
-
-    async def short_video_create(self, session: aiohttp.ClientSession, video_path: str) -> Dict:
-        file_size = os.path.getsize(video_path)
+        if not unique_path:
+            return None, "uniqueization_failed"
+        return unique_path, None
+
+    async def uniqueize_batch(self, paths: List[str]) -> List[Tuple[Optional[str], Optional[str]]]:
+        """Uniqueizes clips in groups of NVENC_SESSIONS, one ffmpeg process per group.
+
+        Saves the process start-up and encoder initialisation per clip. Each output of a
+        group holds one encoder session, so an NVENC group takes that many slots from
+        _nvenc_sessions. If the combined graph fails (e.g. one clip has no audio stream),
+        the clips of that group are retried one by one.
+        """
+        if not await self._check_ffmpeg_installed():
+            return [(None, "ffmpeg is not installed or not found in PATH") for _ in paths]
+        results = []
+        for start in range(0, len(paths), self.NVENC_SESSIONS):
+            chunk = paths[start:start + self.NVENC_SESSIONS]
+            if len(chunk) == 1:
+                results.append(await self.uniqueize_one(chunk[0]))
+                continue
+            unique_paths = [self._unique_path(path) for path in chunk]
+            try:
+                use_nvenc = await self._check_nvenc_available()
+                args = self._uniqueize_batch_args(chunk, unique_paths, use_nvenc)
+                if use_nvenc:
+                    # Each output of the group opens its own encoder session
+                    async with self._nvenc_sessions(len(chunk)):
+                        await self._run_ffmpeg(args)
+                else:
+                    await self._run_ffmpeg(args)
+            except Exception as e:
+                logger.warning(f"Batch uniqueization failed, retrying clips one by one: {e}")
+                for path in chunk:
+                    results.append(await self.uniqueize_one(path))
+                continue
+            results.extend(await asyncio.to_thread(
+                lambda: [self._take_unique_result(p, u) for p, u in zip(chunk, unique_paths)]
+            ))
+        return results
+
+    async def short_video_create(self, session: aiohttp.ClientSession, file_size: int) -> Dict:
         response = await self._api_post(session, "shortVideo.create", {"file_size": str(file_size)})
         if "response" not in response or "upload_url" not in response["response"]:
             raise Exception("Failed to get upload_url from VK API")
@@ -152,10 +527,9 @@ class VKWorker:
             }
         )
 
-    async def short_video_create_from_group(self, session: aiohttp.ClientSession, video_path: str) -> Dict:
+    async def short_video_create_from_group(self, session: aiohttp.ClientSession, file_size: int) -> Dict:
         if self.group_id is None:
             raise ValueError("group_id must be provided for group operations")
-        file_size = os.path.getsize(video_path)
         response = await self._api_post(session, "shortVideo.create", {
             "file_size": str(file_size),
             "group_id": str(self.group_id)
@@ -190,46 +564,92 @@ class VKWorker:
 
     @staticmethod
     async def upload_file_to_url(session: aiohttp.ClientSession, upload_url: str, path: str) -> Dict:
-        with open(path, "rb") as f:
-            data = {"file": f}
-            async with session.post(upload_url, data=data) as resp:
+        """Streams the file as multipart/form-data.
+
+        aiohttp's file payload reads the body in chunks on the default executor and knows its
+        size, so the request gets a Content-Length and the file is never loaded into memory;
+        only the open() itself is moved off the event loop here.
+        """
+        f = await asyncio.to_thread(open, path, "rb")
+        try:
+            form = aiohttp.FormData()
+            form.add_field("file", f, filename=os.path.basename(path), content_type="video/mp4")
+            async with session.post(upload_url, data=form) as resp:
                 resp.raise_for_status()
                 return await resp.json()
+        finally:
+            f.close()
 
     @staticmethod
-    def build_description(item: Dict, fallback: str = "ПОДПИШИТЕСЬ НА ЛУЧШИЕ МЕМЫ") -> str:
-        parts = []
+    def build_description(item: Dict, header: str = _DESCRIPTION_HEADER) -> str:
+        def tokens():
+            # The header always leads and the tracking tags always close the description;
+            # the item's own hashtags, if any, go in between
+            yield header
+            for key in ("description", "title", "caption", "text"):
+                val = item.get(key)
+                if isinstance(val, str):
+                    yield from _HASHTAG_RE.findall(val)
+            yield f"#vkclips #top #video{item.get('owner_id')}_{item.get('id')}"
+
+        # dict.fromkeys drops repeated hashtags while keeping their first-seen order
+        return " — ".join(dict.fromkeys(tokens()))[:999]
 
-        for key in ("description", "title", "caption", "text"):
-            val = item.get(key)
-            if isinstance(val, str) and val.strip():
-                # Find all hashtags in the text
-                hashtags = [word for word in val.split() if word.startswith("#")]
-                parts.extend(hashtags)
+    @staticmethod
+    def link_from_item(item: Dict) -> str:
+        return f"https://vk.com/video{item.get('owner_id')}_{item.get('id')}"
 
-   
-        parts.insert(0, "ПОДПИШИТЕСЬ НА ЛУЧШИЕ МЕМЫ")
+    @staticmethod
+    def clean_videos_dir(keep: Set[str] = frozenset()):
+        """Empties VIDEOS_DIR in place, keeping the directory itself (bind mounts / watchers stay valid).
 
-    
-        owner_id = item.get("owner_id")
-        vid = item.get("id")
-        parts.append(f"#vkclips #top #video{owner_id}_{vid}")
+        Absolute paths in `keep` (cached clips and their index) are left untouched.
+        """
+        try:
+            entries = list(os.scandir(VIDEOS_DIR))
+        except FileNotFoundError:
+            os.makedirs(VIDEOS_DIR, exist_ok=True)
+            return
+        if not os.access(VIDEOS_DIR, os.W_OK):
+            raise PermissionError(f"No write permission for {VIDEOS_DIR}")
+        for entry in entries:
+            if os.path.abspath(entry.path) in keep:
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
 
+    @staticmethod
+    def _cache_key(item: Dict) -> str:
+        return f"{item.get('owner_id')}_{item.get('id')}"
 
-        desc = " — ".join(dict.fromkeys(parts)) if parts else fallback
-        return desc[:999]
+    @staticmethod
+    def _load_cache() -> Dict[str, Dict]:
+        try:
+            with open(CACHE_FILE, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
 
     @staticmethod
-    def link_from_item(item: Dict) -> str:
-        return f"https://vk.com/video{item.get('owner_id')}_{item.get('id')}"
+    def _save_cache(cache: Dict[str, Dict]):
+        tmp_path = CACHE_FILE + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(cache, f, ensure_ascii=False)
+        os.replace(tmp_path, CACHE_FILE)
 
     @staticmethod
-    def clean_videos_dir():
-        if os.path.isdir(VIDEOS_DIR):
-            if not os.access(VIDEOS_DIR, os.W_OK):
-                raise PermissionError(f"No write permission for {VIDEOS_DIR}")
-            shutil.rmtree(VIDEOS_DIR)
-        os.makedirs(VIDEOS_DIR, exist_ok=True)
+    def _cache_entry_valid(entry: Dict) -> bool:
+        """The cached file must still exist unchanged (same non-zero size and mtime)."""
+        try:
+            st = os.stat(entry["path"])
+        except (OSError, KeyError):
+            return False
+        return st.st_size > 0 and st.st_size == entry.get("size") and st.st_mtime == entry.get("mtime")
 
     async def run_cycle(self, progress_cb):
         state = {
@@ -241,84 +661,152 @@ class VKWorker:
             "published": 0,
             "failed": 0,
             "items": [],
-            "messages": [],
+            # Only the last MAX_LINES_IN_LOG lines are ever shown; older ones are evicted on append
+            "messages": deque(maxlen=self.MAX_LINES_IN_LOG),
         }
+        progress = _Debouncer(progress_cb)
 
-        self.clean_videos_dir()
+        if self._cache is None:
+            self._cache = await asyncio.to_thread(self._load_cache)
+        keep = {os.path.abspath(CACHE_FILE), *(os.path.abspath(e["path"]) for e in self._cache.values())}
+        await asyncio.to_thread(self.clean_videos_dir, keep)
         state["messages"].append("🧹 Очищена папка videos/")
-        await progress_cb(state)
-
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session:
-            state["stage"] = "fetch_top"
-            await progress_cb(state)
-            items = await self.get_top_videos(session, TOP_COUNT)
-            state["total"] = len(items)
-            if not items:
-                state["messages"].append("⚠️ Топ пуст.")
-                await progress_cb(state)
-                return state
-
-            state["messages"].append(f"📥 Найдено в топе: {state['total']}")
-            await progress_cb(state)
-
-            enriched = []
-            semaphore = asyncio.Semaphore(5)
-
-            async def process_item(idx, item):
-                async with semaphore:
-                    link = self.link_from_item(item)
-                    title = item.get("title") or item.get("description") or f"video{item.get('owner_id')}_{item.get('id')}"
+        progress.schedule(state)
+
+        session = self._get_session()
+        state["stage"] = "fetch_top"
+        progress.schedule(state)
+        items = await self.get_top_videos(session, self.TOP_COUNT)
+        state["total"] = len(items)
+        if not items:
+            state["messages"].append("⚠️ Топ пуст.")
+            await progress.flush(state)
+            return state
+
+        state["messages"].append(f"📥 Найдено в топе: {state['total']}")
+        progress.schedule(state)
+
+        # Download -> uniqueize -> upload run as a pipeline connected by queues, so
+        # encoding overlaps with network I/O instead of waiting for the whole stage.
+        # `None` is the end-of-stream sentinel.
+        # One slot per top position, so results keep VK's top order whatever finishes first.
+        # Counters in `state` need no lock: tasks only switch at awaits, never inside `+= 1`.
+        enriched: List[Optional[Dict]] = [None] * len(items)
+        fresh_cache: Dict[str, Dict] = {}  # clips uniqueized or reused in this cycle
+        semaphore = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+        downloaded_q: asyncio.Queue = asyncio.Queue(maxsize=4)
+        uniqueized_q: asyncio.Queue = asyncio.Queue(maxsize=4)
+
+        async def process_item(idx, item):
+            async with semaphore:
+                link = self.link_from_item(item)
+                title = item.get("title") or item.get("description") or f"video{item.get('owner_id')}_{item.get('id')}"
+                key = self._cache_key(item)
+                cached = self._cache.get(key)
+                if cached and await asyncio.to_thread(self._cache_entry_valid, cached):
+                    # Same clip as in a previous cycle: reuse its uniqueized file, skip download + encode
+                    if cached.get("title"):
+                        item = {**item, "title": cached["title"]}
+                    rec = {
+                        "idx": idx, "item": item, "link": link, "path": cached["path"], "status": "uniqueized",
+                        "err": None, "title": title, "size": cached["size"], "name": os.path.basename(cached["path"]),
+                    }
+                    enriched[idx - 1] = rec
+                    fresh_cache[key] = cached
+                    state["downloaded"] += 1
+                    state["uniqueized"] += 1
+                    state["messages"].append(f"♻️ Из кеша: {rec['name']}")
+                    progress.schedule(state)
+                    out_q = uniqueized_q
+                else:
+                    out_q = downloaded_q
                     state["messages"].append(f"⬇️ [{idx}/{state['total']}] Скачиваю: {link}")
-                    await progress_cb(state)
+                    progress.schedule(state)
 
                     path, meta, err = await self.download_one(link, VIDEOS_DIR)
                     if err or not path:
                         state["failed"] += 1
                         state["messages"].append(f"❌ Ошибка скачивания: {err or 'unknown'}")
-                        enriched.append({"item": item, "link": link, "path": None, "status": "download_failed", "err": err, "title": title})
-                        await progress_cb(state)
+                        enriched[idx - 1] = {"idx": idx, "item": item, "link": link, "path": None, "status": "download_failed", "err": err, "title": title}
+                        progress.schedule(state)
                         return
-                    else:
-                        state["downloaded"] += 1
-                        state["messages"].append(f"✅ Скачано: {os.path.basename(path)}")
-                        if meta and meta.get("title"):
-                            item = {**item, "title": meta.get("title")}
-                        state["messages"].append(f"🔄 Уникализация видео: {os.path.basename(path)}")
-                        await progress_cb(state)
-                        unique_path, unique_err = await self.uniqueize_one(path)
-                        if unique_err or not unique_path:
-                            state["failed"] += 1
-                            state["messages"].append(f"❌ Ошибка уникализации: {unique_err or 'unknown'}")
-                            enriched.append({"item": item, "link": link, "path": None, "status": "uniqueize_failed", "err": unique_err, "title": title})
-                        else:
-                            state["uniqueized"] += 1
-                            state["messages"].append(f"✅ Уникализировано: {os.path.basename(unique_path)}")
-                            enriched.append({"item": item, "link": link, "path": unique_path, "status": "uniqueized", "err": None, "title": title})
-                    await progress_cb(state)
-
-            tasks = [process_item(idx, item) for idx, item in enumerate(items, 1)]
-            await asyncio.gather(*tasks)
-
-            for idx, rec in enumerate(enriched, 1):
-                if not rec["path"]:
+                    state["downloaded"] += 1
+                    state["messages"].append(f"✅ Скачано: {os.path.basename(path)}")
+                    if meta and meta.get("title"):
+                        item = {**item, "title": meta.get("title")}
+                    rec = {"idx": idx, "item": item, "link": link, "path": path, "status": "downloaded", "err": None, "title": title}
+                    enriched[idx - 1] = rec
+                    progress.schedule(state)
+            # Hand off only after releasing the slot, so a full queue never holds a download slot
+            await out_q.put(rec)
+
+        async def download_stage():
+            await _gather_or_cancel(*(process_item(idx, item) for idx, item in enumerate(items, 1)))
+            await downloaded_q.put(None)
+
+        async def uniqueize_stage():
+            # A single consumer batches whatever has been downloaded so far (up to
+            # NVENC_SESSIONS clips); each batch reserves its encoder sessions itself.
+            finished = False
+            while not finished:
+                batch = [await downloaded_q.get()]
+                while len(batch) < self.NVENC_SESSIONS and not downloaded_q.empty():
+                    batch.append(downloaded_q.get_nowait())
+                finished = None in batch
+                batch = [rec for rec in batch if rec is not None]
+                if not batch:
                     continue
+                state["messages"].append(f"🔄 Уникализация видео: {len(batch)} шт.")
+                progress.schedule(state)
+                results = await self.uniqueize_batch([rec["path"] for rec in batch])
+                for rec, (unique_path, unique_err) in zip(batch, results):
+                    if unique_err or not unique_path:
+                        state["failed"] += 1
+                        state["messages"].append(f"❌ Ошибка уникализации: {unique_err or 'unknown'}")
+                        rec.update({"path": None, "status": "uniqueize_failed", "err": unique_err})
+                        continue
+                    try:
+                        # Stat/basename once here; the upload stage and the cache reuse them
+                        st = await asyncio.to_thread(os.stat, unique_path)
+                    except OSError as e:
+                        state["failed"] += 1
+                        state["messages"].append(f"❌ Ошибка уникализации: {e}")
+                        rec.update({"path": None, "status": "uniqueize_failed", "err": str(e)})
+                        continue
+                    state["uniqueized"] += 1
+                    rec.update({
+                        "path": unique_path, "status": "uniqueized",
+                        "size": st.st_size, "name": os.path.basename(unique_path),
+                    })
+                    fresh_cache[self._cache_key(rec["item"])] = {
+                        "path": unique_path, "size": st.st_size, "mtime": st.st_mtime,
+                        "title": rec["item"].get("title"),
+                    }
+                    state["messages"].append(f"✅ Уникализировано: {rec['name']}")
+                    await uniqueized_q.put(rec)
+                progress.schedule(state)
+            await uniqueized_q.put(None)
+
+        async def upload_stage():
+            # Uploads stay sequential because of VK flood control
+            while (rec := await uniqueized_q.get()) is not None:
                 path = rec["path"]
                 item = rec["item"]
                 desc = self.build_description(item)
 
-                state["messages"].append(f"🚀 [{idx}/{state['total']}] Загружаю в VK: {os.path.basename(path)}")
-                await progress_cb(state)
+                state["messages"].append(f"🚀 [{rec['idx']}/{state['total']}] Загружаю в VK: {rec['name']}")
+                progress.schedule(state)
 
                 try:
                     if self.group_id:
-                        create_resp = await self.short_video_create_from_group(session, path)
+                        create_resp = await self.short_video_create_from_group(session, rec["size"])
                     else:
-                        create_resp = await self.short_video_create(session, path)
+                        create_resp = await self.short_video_create(session, rec["size"])
 
                     upload_url = create_resp["upload_url"]
                     upload_resp = await self.upload_file_to_url(session, upload_url, path)
 
-                    await asyncio.sleep(PROCESSING_DELAY * 2)
+                    await asyncio.sleep(self.PROCESSING_DELAY * 2)
 
                     if self.group_id:
                         await self.short_video_edit_from_group(session, upload_resp, desc)
@@ -330,16 +818,26 @@ class VKWorker:
                     state["uploaded"] += 1
                     state["published"] += 1
                     rec["status"] = "published"
-                    state["messages"].append(f"🎉 Опубликовано: {os.path.basename(path)}")
+                    state["messages"].append(f"🎉 Опубликовано: {rec['name']}")
+                    progress.schedule(state)
 
                 except Exception as e:
                     state["failed"] += 1
                     rec["status"] = "upload_failed"
                     rec["err"] = str(e)
                     state["messages"].append(f"💥 Ошибка загрузки: {e}")
-                    await progress_cb(state)
+                    progress.schedule(state)
+
+        # Sentinels are only sent on normal completion; if a stage fails the others are
+        # cancelled instead of being left blocked on the bounded queues
+        await _gather_or_cancel(download_stage(), uniqueize_stage(), upload_stage())
+        state["items"] = enriched
+
+        # Only clips from the current top stay cached; the rest are removed by the next clean-up
+        self._cache = fresh_cache
+        await asyncio.to_thread(self._save_cache, fresh_cache)
 
         state["stage"] = "done"
         state["messages"].append("🏁 Готово.")
-        await progress_cb(state)
+        await progress.flush(state)
         return state